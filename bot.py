@@ -1,11 +1,24 @@
 import os
 import json
+import time
+import uuid
+import queue
+import random
+import atexit
+import asyncio
 import logging
+import contextvars
 import aiosqlite
+from logging.handlers import QueueHandler, QueueListener
 from pathlib import Path
-from typing import Dict, Any, List
-
-from aiogram import Bot, Dispatcher, types, F, Router
+from datetime import date, datetime
+from typing import Dict, Any, List, Callable, Awaitable, Tuple, Optional
+
+from aiogram import Bot, Dispatcher, types, F, Router, BaseMiddleware
+from aiogram.dispatcher.flags import get_flag
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.dispatcher.event.bases import UNHANDLED
+from aiogram.methods import GetUpdates
 from aiogram.types import (
     InlineKeyboardMarkup, InlineKeyboardButton, InputMediaPhoto,
     ReplyKeyboardMarkup, KeyboardButton
@@ -25,61 +38,641 @@ BOT_TOKEN = os.environ.get("BOT_TOKEN") or "8428424328:AAEzKaMTCIYfiSmsfwtB7zy9i
 ADMIN_CHAT_ID = int(os.environ.get("ADMIN_CHAT_ID") or "7880534797")
 
 DATA_DIR = Path(__file__).parent
-MENU_FILE = DATA_DIR / "menu.json"
-IMAGES_DIR = DATA_DIR / "images"
-DB_FILE = DATA_DIR / "orders.db"
+
+# Bir nechta filial botlari bitta jarayonda: TENANTS_FILE dagi ro'yxat
+# [{"name": ..., "token": ..., "admin_chat_id": ..., "data_dir": ...}, ...]
+# Berilmasa — yuqoridagi BOT_TOKEN / ADMIN_CHAT_ID / DATA_DIR bilan bitta bot.
+TENANTS_FILE = os.environ.get("TENANTS_FILE")
 
 # LOGGING
-logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    level=logging.INFO
-)
+# Yozuvlar JSON ko'rinishida navbatga tushadi, diskka esa alohida thread yozadi
+LOG_FILE = os.environ.get("LOG_FILE")
+LOG_LEVEL = os.environ.get("LOG_LEVEL") or "INFO"
+LOG_SAMPLE_RATE = float(os.environ.get("LOG_SAMPLE_RATE") or "0.05")
+HOT_CALLBACK_PREFIXES = ("incmenu|", "decmenu|", "inc|", "dec|", "add_")
+
+trace_id_var: contextvars.ContextVar[str] = contextvars.ContextVar("trace_id", default="-")
+trace_sampled_var: contextvars.ContextVar[bool] = contextvars.ContextVar("trace_sampled", default=True)
+tenant_var: contextvars.ContextVar["Tenant"] = contextvars.ContextVar("tenant")
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        payload = {
+            "ts": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "tenant": getattr(record, "tenant", "-"),
+            "trace_id": getattr(record, "trace_id", "-"),
+            "msg": record.getMessage(),
+        }
+        payload.update(getattr(record, "fields", {}))
+        if record.exc_info:
+            payload["exc"] = self.formatException(record.exc_info)
+        return json.dumps(payload, ensure_ascii=False, default=str)
+
+
+class TraceFilter(logging.Filter):
+    """Trace id ni yozuvga qo'shadi; tanlanmagan update lar uchun faqat WARNING+ o'tadi."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.trace_id = trace_id_var.get()
+        t = tenant_var.get(None)
+        record.tenant = t.name if t else "-"
+        return record.levelno >= logging.WARNING or trace_sampled_var.get()
+
+
+def setup_logging() -> QueueListener:
+    if LOG_FILE:
+        target = logging.FileHandler(LOG_FILE, encoding="utf-8")
+    else:
+        target = logging.StreamHandler()
+    target.setFormatter(logging.Formatter("%(message)s"))
+
+    # JSON event loop thread ida tayyorlanadi (contextvars shu yerda ko'rinadi),
+    # I/O esa listener thread ida bajariladi
+    queue_handler = QueueHandler(queue.SimpleQueue())
+    queue_handler.addFilter(TraceFilter())
+    queue_handler.setFormatter(JsonFormatter())
+
+    root = logging.getLogger()
+    root.handlers[:] = [queue_handler]
+    root.setLevel(LOG_LEVEL)
+    # aiogram ning "Update id=... is handled" yozuvi trace/sampling tashqarisida
+    # chiqadi — uning o'rniga TracingMiddleware o'zi yozadi
+    logging.getLogger("aiogram.event").setLevel(logging.WARNING)
+
+    listener = QueueListener(queue_handler.queue, target, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+log_listener = setup_logging()
 logger = logging.getLogger(__name__)
 
 # --- LOAD MENU ---
-def load_menu() -> List[Dict[str, Any]]:
+def load_menu(menu_file: Path) -> List[Dict[str, Any]]:
     try:
-        with open(MENU_FILE, "r", encoding="utf-8") as f:
+        with open(menu_file, "r", encoding="utf-8") as f:
             return json.load(f)
     except Exception as e:
-        logger.error(f"Error reading menu.json: {e}")
+        logger.error(f"Error reading {menu_file}: {e}")
         return []
 
-MENU = load_menu()
-MENU_BY_ID = {item["id"]: item for item in MENU}
+# --- TENANTS (filiallar) ---
+class Tenant:
+    """Bitta filial: o'z katalogi, savatlari, ombori va bazasi."""
+
+    def __init__(self, name: str, token: str, admin_chat_id: int, data_dir: Path):
+        self.name = name
+        self.token = token
+        self.admin_chat_id = admin_chat_id
+        self.images_dir = data_dir / "images"
+        self.db_file = data_dir / "orders.db"
+        self.archive_dir = data_dir / "archive"
+
+        self.menu = load_menu(data_dir / "menu.json")
+        self.menu_by_id = {item["id"]: item for item in self.menu}
+
+        self.carts: Dict[int, Dict[int, int]] = {}
+        self.order_counter = 1   # <<< BUYURTMA RAQAM TIZIMI SHU YERGA QO‘YILADI
+
+        self.stock_reserved: Dict[Tuple[str, int], int] = {}   # (kun, pid) -> band qilingan
+        self.stock_dirty: set = set()
+        # order_id -> [kun, {pid: qty}, yaratilgan vaqt (unix), user_id] — chek kutilayotganlar
+        self.order_reservations: Dict[int, List[Any]] = {}
+        self.reservations_dirty: set = set()   # DB ga yozilmagan order_id lar
+        self.counter_flushed = 0
+        self.dirty_traces: set = set()         # flush kutilayotgan o'zgarishlar trace id lari
+
+
+def load_tenants() -> List[Tenant]:
+    if not TENANTS_FILE:
+        return [Tenant("default", BOT_TOKEN, ADMIN_CHAT_ID, DATA_DIR)]
+
+    with open(TENANTS_FILE, "r", encoding="utf-8") as f:
+        config = json.load(f)
+
+    base = Path(TENANTS_FILE).parent
+    return [
+        Tenant(c["name"], c["token"], int(c["admin_chat_id"]), base / c["data_dir"])
+        for c in config
+    ]
+
+tenants: Dict[int, Tenant] = {}   # bot.id -> Tenant
 
 # --- DATABASE ---
-async def init_db():
-    async with aiosqlite.connect(DB_FILE) as db:
+DB_TIMEOUT = 10.0   # boshqa yozuvchi lockni bo'shatishini kutish (soniya)
+
+ORDERS_TABLE = """
+    CREATE TABLE IF NOT EXISTS {schema}orders (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        user_name TEXT,
+        phone TEXT,
+        address TEXT,
+        total INTEGER,
+        status TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+"""
+ORDER_ITEMS_TABLE = """
+    CREATE TABLE IF NOT EXISTS {schema}order_items (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        order_id INTEGER,
+        product_id INTEGER,
+        name TEXT,
+        price INTEGER,
+        qty INTEGER
+    );
+"""
+
+async def init_db(db_file: Path):
+    async with aiosqlite.connect(db_file, timeout=DB_TIMEOUT) as db:
+        # WAL: o'quvchilar yozuvchini to'xtatmaydi; incremental vacuum
+        # esa bo'sh sahifalarni bo'lib-bo'lib qaytarish imkonini beradi
+        await db.execute("PRAGMA journal_mode=WAL")
+        async with db.execute("PRAGMA auto_vacuum") as cur:
+            (auto_vacuum,) = await cur.fetchone()
+        if auto_vacuum != 2:
+            # Bir martalik: polling boshlanishidan oldin, jonli trafik yo'q
+            await db.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            await db.execute("VACUUM")
+
+        await db.execute(ORDERS_TABLE.format(schema=""))
+        await db.execute(ORDER_ITEMS_TABLE.format(schema=""))
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS stock (
+                day TEXT,
+                product_id INTEGER,
+                reserved INTEGER,
+                PRIMARY KEY (day, product_id)
+            );
+        """)
+        # Chek kutilayotgan band qilishlar va buyurtma raqami restartdan keyin ham saqlanadi
         await db.execute("""
-            CREATE TABLE IF NOT EXISTS orders (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                user_name TEXT,
-                phone TEXT,
-                address TEXT,
-                total INTEGER,
-                status TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            CREATE TABLE IF NOT EXISTS reservations (
+                order_id INTEGER PRIMARY KEY,
+                day TEXT,
+                items TEXT,
+                created_at REAL,
+                user_id INTEGER
             );
         """)
         await db.execute("""
-            CREATE TABLE IF NOT EXISTS order_items (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                order_id INTEGER,
-                product_id INTEGER,
-                name TEXT,
-                price INTEGER,
-                qty INTEGER
+            CREATE TABLE IF NOT EXISTS counters (
+                name TEXT PRIMARY KEY,
+                value INTEGER
+            );
+        """)
+        # Arxivga ko'chirilgan buyurtmalar kunlik yig'indisi shu yerda qoladi
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS order_stats (
+                day TEXT PRIMARY KEY,
+                orders INTEGER,
+                revenue INTEGER
             );
         """)
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_orders_created_at ON orders (created_at)")
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_order_items_order_id ON order_items (order_id)")
         await db.commit()
 
-# --- CARTS ---
-carts: Dict[int, Dict[int, int]] = {}
+# --- STOCK (kunlik pishirish sig'imi) ---
+# menu.json dagi "capacity" — bir kunda pishiriladigan non soni.
+# Band qilishlar xotirada sanaladi va vaqti-vaqti bilan SQLite ga yoziladi.
+STOCK_FLUSH_EVERY = 30.0          # soniya
+ORDER_HOLD_TTL = 2 * 60 * 60      # chek yuborilmasa band qilish bekor bo'ladi
+
+
+def today() -> str:
+    return date.today().isoformat()
+
+def stock_left(t: Tenant, pid: int, day: str = None) -> int:
+    capacity = t.menu_by_id[pid].get("capacity")
+    if capacity is None:
+        return 10 ** 9
+    return max(0, capacity - t.stock_reserved.get((day or today(), pid), 0))
+
+def stock_label(t: Tenant, pid: int) -> str:
+    left = stock_left(t, pid)
+    if left <= 0:
+        return "❌ Bugun sotuvda qolmadi"
+    if t.menu_by_id[pid].get("capacity") is None:
+        return ""
+    return f"Bugun qoldi: {left} dona"
+
+def reserve_stock(t: Tenant, order_id: int, uid: int, cart: Dict[int, int]) -> bool:
+    # await yo'q — event loop ichida tekshirish va band qilish atomar
+    day = today()
+    if any(qty > stock_left(t, pid, day) for pid, qty in cart.items()):
+        return False
+    for pid, qty in cart.items():
+        t.stock_reserved[(day, pid)] = t.stock_reserved.get((day, pid), 0) + qty
+        t.stock_dirty.add((day, pid))
+    t.order_reservations[order_id] = [day, dict(cart), time.time(), uid]
+    t.reservations_dirty.add(order_id)
+    t.dirty_traces.add(trace_id_var.get())
+    return True
+
+def release_stock(t: Tenant, order_id: int) -> bool:
+    res = t.order_reservations.pop(order_id, None)
+    if res is None:
+        return False
+    t.reservations_dirty.add(order_id)
+    t.dirty_traces.add(trace_id_var.get())
+    day, items = res[0], res[1]
+    for pid, qty in items.items():
+        t.stock_reserved[(day, pid)] = max(0, t.stock_reserved.get((day, pid), 0) - qty)
+        t.stock_dirty.add((day, pid))
+    return True
+
+def user_reservation(t: Tenant, uid: int) -> Optional[int]:
+    """Foydalanuvchining eng oxirgi chek kutilayotgan buyurtmasi."""
+    own = [oid for oid, res in t.order_reservations.items() if res[3] == uid]
+    return max(own) if own else None
+
+def settle_reservation(t: Tenant, order_id: int):
+    # Chek keldi: nonlar sotilgan, kunlik hisoblagichda qoladi
+    if t.order_reservations.pop(order_id, None) is not None:
+        t.reservations_dirty.add(order_id)
+        t.dirty_traces.add(trace_id_var.get())
+
+async def load_stock(t: Tenant):
+    async with aiosqlite.connect(t.db_file) as db:
+        async with db.execute(
+            "SELECT day, product_id, reserved FROM stock WHERE day = ?", (today(),)
+        ) as cur:
+            async for day, pid, reserved in cur:
+                t.stock_reserved[(day, pid)] = reserved
+
+        async with db.execute(
+            "SELECT order_id, day, items, created_at, user_id FROM reservations"
+        ) as cur:
+            async for order_id, day, items, created_at, uid in cur:
+                items = {int(pid): qty for pid, qty in json.loads(items).items()}
+                t.order_reservations[order_id] = [day, items, created_at, uid]
+
+        async with db.execute("SELECT value FROM counters WHERE name = 'order'") as cur:
+            row = await cur.fetchone()
+        t.order_counter = max([row[0] if row else 1, *(oid + 1 for oid in t.order_reservations)])
+        t.counter_flushed = t.order_counter
+
+async def flush_stock(t: Tenant):
+    if not t.stock_dirty and not t.reservations_dirty and t.counter_flushed == t.order_counter:
+        return
+    keys = list(t.stock_dirty)
+    order_ids = list(t.reservations_dirty)
+    counter = t.order_counter
+    traces = sorted(t.dirty_traces - {"-"})
+    t.stock_dirty.clear()
+    t.reservations_dirty.clear()
+    t.dirty_traces.clear()
+
+    rows = [(day, pid, t.stock_reserved.get((day, pid), 0)) for day, pid in keys]
+    upserts = [
+        (oid, res[0], json.dumps(res[1]), res[2], res[3])
+        for oid in order_ids if (res := t.order_reservations.get(oid)) is not None
+    ]
+    deletes = [(oid,) for oid in order_ids if oid not in t.order_reservations]
+    try:
+        async with aiosqlite.connect(t.db_file) as db:
+            await db.executemany(
+                "INSERT INTO stock (day, product_id, reserved) VALUES (?, ?, ?) "
+                "ON CONFLICT(day, product_id) DO UPDATE SET reserved = excluded.reserved",
+                rows
+            )
+            await db.executemany(
+                "INSERT OR REPLACE INTO reservations (order_id, day, items, created_at, user_id) "
+                "VALUES (?, ?, ?, ?, ?)",
+                upserts
+            )
+            await db.executemany("DELETE FROM reservations WHERE order_id = ?", deletes)
+            await db.execute(
+                "INSERT OR REPLACE INTO counters (name, value) VALUES ('order', ?)", (counter,)
+            )
+            await db.commit()
+        t.counter_flushed = counter
+        logger.info(
+            "stock flushed",
+            # Yozuv fon task da — qaysi update lar sababchi ekanini shu bilan bog'laymiz
+            extra={"fields": {
+                "rows": len(rows), "reservations": len(order_ids), "trace_ids": traces,
+            }}
+        )
+    except Exception:
+        t.stock_dirty.update(keys)
+        t.reservations_dirty.update(order_ids)
+        t.dirty_traces.update(traces)
+        logger.exception("flush_stock failed")
+
+def expire_reservations(t: Tenant):
+    now = time.time()
+    day = today()
+    for order_id, res in list(t.order_reservations.items()):
+        if res[0] < day:
+            # O'tgan kun — nonlar allaqachon o'sha kun hisobida, faqat yozuvni tashlaymiz
+            del t.order_reservations[order_id]
+            t.reservations_dirty.add(order_id)
+        elif now - res[2] > ORDER_HOLD_TTL:
+            release_stock(t, order_id)
+            logger.info(f"Order #{order_id} reservation expired")
+
+    # O'tgan kunlar hisoblagichlari DB da qoladi, xotiradan o'chiriladi
+    for key in list(t.stock_reserved):
+        if key[0] < day and key not in t.stock_dirty:
+            del t.stock_reserved[key]
+
+async def stock_flusher(t: Tenant):
+    tenant_var.set(t)   # task o'z kontekstida — loglar filial nomi bilan
+    while True:
+        await asyncio.sleep(STOCK_FLUSH_EVERY)
+        expire_reservations(t)
+        await flush_stock(t)
+
+# --- DB MAINTENANCE (arxiv, vacuum, analyze) ---
+RETENTION_DAYS = int(os.environ.get("RETENTION_DAYS") or "180")
+MAINTENANCE_HOURS = range(2, 6)     # tungi soatlar (server vaqti)
+MAINTENANCE_EVERY = 30 * 60         # soniya
+ARCHIVE_BATCH = 200                 # bitta tranzaksiyadagi buyurtmalar soni
+VACUUM_PAGES = 500                  # bitta incremental_vacuum qadamidagi sahifalar
+ANALYSIS_LIMIT = 400                # ANALYZE indeks bo'yicha ko'rib chiqadigan qatorlar chegarasi
+MAINTENANCE_PAUSE = 0.5             # batchlar orasida — jonli yozuvlarga navbat
+
+
+async def archive_batch(t: Tenant) -> int:
+    """Eng eski buyurtmalardan bir batchni oylik arxiv bazasiga ko'chiradi."""
+    async with aiosqlite.connect(t.db_file, timeout=DB_TIMEOUT) as db:
+        async with db.execute(
+            "SELECT id, strftime('%Y-%m', created_at) FROM orders "
+            "WHERE created_at < datetime('now', ?) ORDER BY id LIMIT ?",
+            (f"-{RETENTION_DAYS} days", ARCHIVE_BATCH)
+        ) as cur:
+            rows = await cur.fetchall()
+        if not rows:
+            return 0
+
+        by_month: Dict[str, List[int]] = {}
+        for order_id, month in rows:
+            by_month.setdefault(month, []).append(order_id)
+
+        t.archive_dir.mkdir(parents=True, exist_ok=True)
+        for month, ids in by_month.items():
+            await db.execute(
+                "ATTACH DATABASE ? AS arch", (str(t.archive_dir / f"orders-{month}.db"),)
+            )
+            try:
+                await db.execute(ORDERS_TABLE.format(schema="arch."))
+                await db.execute(ORDER_ITEMS_TABLE.format(schema="arch."))
+                await db.commit()
+
+                marks = ",".join("?" * len(ids))
+                # WAL rejimida ATTACH qilingan bazalar orasidagi tranzaksiya birgalikda
+                # atomar emas — avval arxiv nusxasi alohida commit qilinadi.
+                # Qayta urinishda INSERT OR IGNORE dublikat yaratmaydi.
+                await db.execute(
+                    f"INSERT OR IGNORE INTO arch.orders SELECT * FROM orders WHERE id IN ({marks})", ids
+                )
+                await db.execute(
+                    f"INSERT OR IGNORE INTO arch.order_items "
+                    f"SELECT * FROM order_items WHERE order_id IN ({marks})", ids
+                )
+                await db.commit()
+
+                # Keyin faqat main: yig'indi + o'chirish. Lock shu batch davomida ushlanadi
+                await db.execute("BEGIN IMMEDIATE")
+                await db.execute(
+                    f"INSERT INTO order_stats (day, orders, revenue) "
+                    f"SELECT date(created_at), COUNT(*), COALESCE(SUM(total), 0) "
+                    f"FROM orders WHERE id IN ({marks}) GROUP BY date(created_at) "
+                    f"ON CONFLICT(day) DO UPDATE SET "
+                    f"orders = orders + excluded.orders, revenue = revenue + excluded.revenue", ids
+                )
+                await db.execute(f"DELETE FROM order_items WHERE order_id IN ({marks})", ids)
+                await db.execute(f"DELETE FROM orders WHERE id IN ({marks})", ids)
+                await db.commit()
+            except Exception:
+                await db.rollback()
+                raise
+            finally:
+                await db.execute("DETACH DATABASE arch")
+
+        logger.info("orders archived", extra={"fields": {"orders": len(rows), "months": sorted(by_month)}})
+        return len(rows)
+
+
+def in_maintenance_window() -> bool:
+    return datetime.now().hour in MAINTENANCE_HOURS
+
+
+async def compact_db(t: Tenant):
+    async with aiosqlite.connect(t.db_file, timeout=DB_TIMEOUT) as db:
+        async with db.execute("PRAGMA freelist_count") as cur:
+            (free_pages,) = await cur.fetchone()
+
+        # Faqat boshidagi bo'sh sahifalar qaytariladi: jonli trafik yangilarini
+        # bo'shatib tursa ham sikl tugaydi
+        steps = -(-free_pages // VACUUM_PAGES)
+        for _ in range(steps):
+            if not in_maintenance_window():
+                return
+            # sqlite3 ``execute`` pragmani bir marta step qiladi (= 1 sahifa);
+            # executescript esa butun qadamni oxirigacha bajaradi
+            await db.executescript(f"PRAGMA incremental_vacuum({VACUUM_PAGES});")
+            await asyncio.sleep(MAINTENANCE_PAUSE)
+
+        if not in_maintenance_window():
+            return
+        # analysis_limit bilan ANALYZE — katta bazada ham lock qisqa
+        await db.executescript(f"PRAGMA analysis_limit={ANALYSIS_LIMIT}; ANALYZE;")
+        await db.execute("PRAGMA wal_checkpoint(PASSIVE)")
+
+
+async def run_maintenance(t: Tenant):
+    archived = 0
+    while in_maintenance_window():
+        moved = await archive_batch(t)
+        if not moved:
+            break
+        archived += moved
+        await asyncio.sleep(MAINTENANCE_PAUSE)
+
+    if in_maintenance_window():
+        await compact_db(t)
+    logger.info("db maintenance done", extra={"fields": {"archived": archived}})
+
+
+async def db_maintainer(t: Tenant):
+    tenant_var.set(t)
+    done_on = None
+    while True:
+        await asyncio.sleep(MAINTENANCE_EVERY)
+        if not in_maintenance_window() or done_on == today():
+            continue
+        try:
+            await run_maintenance(t)
+            done_on = today()
+        except Exception:
+            logger.exception("db maintenance failed")
+
+
+# --- ANTI-FLOOD (THROTTLING) ---
+# Har bir foydalanuvchi uchun token bucket: (sig'im, soniyasiga to'ldirish)
+THROTTLE_RATES: Dict[str, Tuple[float, float]] = {
+    "cart": (8, 2.0),    # arzon callbacklar: ➕ / ➖ / Qo'shish
+    "menu": (2, 1 / 15), # qimmat: /menu har safar N ta rasm yuboradi
+}
+THROTTLE_STRIKES = 10        # ketma-ket tashlangan so'rovlar soni → cooldown
+THROTTLE_COOLDOWN = 60.0     # cooldown davomiyligi (soniya)
+THROTTLE_SWEEP_EVERY = 300.0 # eski bucketlarni tozalash oralig'i (soniya)
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """Handler flagidagi ``throttling_key`` bo'yicha per-user rate limit.
+
+    Foydalanuvchi ``(bot_id, uid)`` juftligi bilan aniqlanadi — bir filialdagi
+    cooldown boshqa filial botiga ta'sir qilmaydi. Bucket holati
+    ``((bot_id, uid), key) -> [tokens, last_ts, strikes]`` ko'rinishida
+    saqlanadi va to'lib qolgan (ya'ni faol bo'lmagan) bucketlar davriy
+    ravishda o'chiriladi.
+    """
+
+    def __init__(self, rates: Dict[str, Tuple[float, float]] = THROTTLE_RATES):
+        self.rates = rates
+        self.buckets: Dict[Tuple[Tuple[int, int], str], List[float]] = {}
+        self.cooldowns: Dict[Tuple[int, int], float] = {}
+        self.last_sweep = time.monotonic()
+
+    def _sweep(self, now: float):
+        for bkey, (tokens, ts, _) in list(self.buckets.items()):
+            capacity, rate = self.rates[bkey[1]]
+            if tokens + (now - ts) * rate >= capacity:
+                del self.buckets[bkey]
+        for who, until in list(self.cooldowns.items()):
+            if until <= now:
+                del self.cooldowns[who]
+        self.last_sweep = now
+
+    def _allow(self, who: Tuple[int, int], key: str, now: float) -> bool:
+        if self.cooldowns.get(who, 0) > now:
+            return False
+
+        capacity, rate = self.rates[key]
+        bucket = self.buckets.get((who, key))
+        if bucket is None:
+            bucket = self.buckets[(who, key)] = [capacity, now, 0]
+
+        bucket[0] = min(capacity, bucket[0] + (now - bucket[1]) * rate)
+        bucket[1] = now
+
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            bucket[2] = 0
+            return True
+
+        bucket[2] += 1
+        if bucket[2] >= THROTTLE_STRIKES:
+            self.cooldowns[who] = now + THROTTLE_COOLDOWN
+            bucket[2] = 0
+            logger.warning(f"User {who[1]} throttled for {THROTTLE_COOLDOWN:.0f}s ({key}, bot {who[0]})")
+        return False
+
+    async def __call__(
+        self,
+        handler: Callable[[types.TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: types.TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        key = get_flag(data, "throttling_key")
+        user = data.get("event_from_user")
+        if key not in self.rates or user is None:
+            return await handler(event, data)
+
+        now = time.monotonic()
+        if now - self.last_sweep >= THROTTLE_SWEEP_EVERY:
+            self._sweep(now)
+
+        if self._allow((data["bot"].id, user.id), key, now):
+            return await handler(event, data)
+
+        # Ortiqcha bosishlar jimgina tashlanadi
+        if isinstance(event, types.CallbackQuery):
+            await event.answer()
+        return None
+
+
+# --- TENANT ---
+class TenantMiddleware(BaseMiddleware):
+    """Update kelgan bot bo'yicha filialni handlerlarga ``tenant`` sifatida beradi."""
+
+    async def __call__(
+        self,
+        handler: Callable[[types.TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: types.Update,
+        data: Dict[str, Any],
+    ) -> Any:
+        data["tenant"] = tenants[data["bot"].id]
+        token = tenant_var.set(data["tenant"])   # loglar uchun
+        try:
+            return await handler(event, data)
+        finally:
+            tenant_var.reset(token)
+
+
+# --- TRACING ---
+class TracingMiddleware(BaseMiddleware):
+    """Har bir update uchun trace id o'rnatadi (handler, DB va Bot API loglari uchun)."""
+
+    async def __call__(
+        self,
+        handler: Callable[[types.TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: types.Update,
+        data: Dict[str, Any],
+    ) -> Any:
+        sampled = True
+        cq = event.callback_query
+        if cq and cq.data and cq.data.startswith(HOT_CALLBACK_PREFIXES):
+            sampled = random.random() < LOG_SAMPLE_RATE
+
+        trace_token = trace_id_var.set(f"{event.update_id:x}-{uuid.uuid4().hex[:8]}")
+        sampled_token = trace_sampled_var.set(sampled)
+        start = time.monotonic()
+        result = UNHANDLED
+        try:
+            result = await handler(event, data)
+            return result
+        finally:
+            logger.info(
+                "update processed",
+                extra={"fields": {
+                    "update_id": event.update_id,
+                    "type": event.event_type,
+                    "handled": result is not UNHANDLED,
+                    "ms": round((time.monotonic() - start) * 1000, 1),
+                }}
+            )
+            trace_id_var.reset(trace_token)
+            trace_sampled_var.reset(sampled_token)
+
+
+async def log_bot_api(make_request, bot: Bot, method):
+    start = time.monotonic()
+    ok = False
+    try:
+        result = await make_request(bot, method)
+        ok = True
+        return result
+    finally:
+        # Long-poll har bir tsiklda chaqiriladi — faqat DEBUG da
+        logger.log(
+            logging.DEBUG if isinstance(method, GetUpdates) else logging.INFO,
+            "bot api call",
+            extra={"fields": {
+                "method": type(method).__name__,
+                "ok": ok,
+                "ms": round((time.monotonic() - start) * 1000, 1),
+            }}
+        )
 
-# --- ORDER COUNTER ---
-order_counter = 1   # <<< BUYURTMA RAQAM TIZIMI SHU YERGA QO‘YILADI
 
 # --- FSM ----
 class CheckoutStates(StatesGroup):
@@ -112,23 +705,26 @@ main_kb = ReplyKeyboardMarkup(
 def format_price(summa: int) -> str:
     return f"{summa:,} UZS".replace(",", " ")
 
-def cart_total(cart: Dict[int, int]) -> int:
-    return sum(MENU_BY_ID[pid]["price"] * qty for pid, qty in cart.items())
+def cart_total(t: Tenant, cart: Dict[int, int]) -> int:
+    return sum(t.menu_by_id[pid]["price"] * qty for pid, qty in cart.items())
 
-def cart_text(cart: Dict[int, int]) -> str:
+def cart_text(t: Tenant, cart: Dict[int, int]) -> str:
     if not cart:
         return "Sizning savatingiz bo'sh."
     lines = []
     for pid, qty in cart.items():
-        it = MENU_BY_ID[pid]
+        it = t.menu_by_id[pid]
         lines.append(f"{it['name']} x{qty} — {format_price(it['price'] * qty)}")
-    lines.append(f"\nJami: {format_price(cart_total(cart))}")
+    lines.append(f"\nJami: {format_price(cart_total(t, cart))}")
     return "\n".join(lines)
 
 # ------------------------------------------------------
 #                   ROUTER
 # ------------------------------------------------------
 router = Router()
+throttling = ThrottlingMiddleware()
+router.message.middleware(throttling)
+router.callback_query.middleware(throttling)
 
 # START
 @router.message(CommandStart())
@@ -166,7 +762,7 @@ async def save_start_location(message: types.Message, state: FSMContext):
 
 # LOCATION RECEIVED
 @router.message(F.location)
-async def location_received(message: types.Message, state: FSMContext):
+async def location_received(message: types.Message, state: FSMContext, tenant: Tenant):
     current = await state.get_state()
 
     # Agar buyurtma jarayonida bo‘lsa → lokatsiya manzil sifatida saqlanadi
@@ -177,14 +773,14 @@ async def location_received(message: types.Message, state: FSMContext):
         await state.update_data(address=f"Lokatsiya: {lat}, {lon}")
 
         uid = message.from_user.id
-        cart = carts.get(uid, {})
+        cart = tenant.carts.get(uid, {})
         data = await state.get_data()
 
-        total = cart_total(cart)  # <<< --- MUHIM --- jami summa
+        total = cart_total(tenant, cart)  # <<< --- MUHIM --- jami summa
 
         text = (
             f"📦 *Buyurtma tafsilotlari:*\n\n"
-            f"{cart_text(cart)}\n"
+            f"{cart_text(tenant, cart)}\n"
             f"💰 *Jami summa:* {format_price(total)}\n\n"
             f"📞 Telefon: {data['phone']}\n"
             f"📍 Lokatsiya: {lat}, {lon}\n\n"
@@ -228,22 +824,23 @@ async def help_cmd(message: types.Message):
 # ============================
 #   MENYU BUTTON (reply)
 # ============================
-@router.message(F.text == "🍞 Menyu")
-async def menu_btn(message: types.Message):
-    await menu_cmd(message)
+@router.message(F.text == "🍞 Menyu", flags={"throttling_key": "menu"})
+async def menu_btn(message: types.Message, tenant: Tenant):
+    await menu_cmd(message, tenant)
 # ============================
 #        /menu COMMAND
 # ============================
-@router.message(Command("menu"))
-async def menu_cmd(message: types.Message):
+@router.message(Command("menu"), flags={"throttling_key": "menu"})
+async def menu_cmd(message: types.Message, tenant: Tenant):
     bot = message.bot
 
-    for item in MENU:
+    for item in tenant.menu:
 
         caption = (
             f"*{item['name']}*\n"
             f"{item['description']}\n\n"
-            f"Narx: {format_price(item['price'])}"
+            f"Narx: {format_price(item['price'])}\n"
+            f"{stock_label(tenant, item['id'])}"
         )
 
         kb = InlineKeyboardMarkup(
@@ -256,7 +853,7 @@ async def menu_cmd(message: types.Message):
             ]
         )
 
-        img_path = IMAGES_DIR / item["image"]
+        img_path = tenant.images_dir / item["image"]
 
         if img_path.exists():
             await bot.send_photo(
@@ -278,17 +875,19 @@ def cart_only_clean_kb():
 
 
 # ADD TO CART
-@router.callback_query(F.data.startswith("add_"))
-async def add_to_cart(callback: types.CallbackQuery):
+@router.callback_query(F.data.startswith("add_"), flags={"throttling_key": "cart"})
+async def add_to_cart(callback: types.CallbackQuery, tenant: Tenant):
     pid = int(callback.data.split("_")[1])
     uid = callback.from_user.id
 
-    cart = carts.setdefault(uid, {})
+    cart = tenant.carts.setdefault(uid, {})
+    if cart.get(pid, 0) >= stock_left(tenant, pid):
+        return await callback.answer("Bugun boshqa qolmadi ❌")
     cart[pid] = cart.get(pid, 0) + 1
 
     # Обновляем карточку товара (если это карточка товара)
     try:
-        await refresh_menu_item(callback, pid)
+        await refresh_menu_item(tenant, callback, pid)
     except Exception:
         # если обновить не получилось, просто игнорируем (в лог можно вывести)
         logger.exception("refresh_menu_item failed on add_to_cart")
@@ -301,54 +900,54 @@ async def add_to_cart(callback: types.CallbackQuery):
 
 # SAVAT (Reply button)
 @router.message(F.text == "🛒 Savat")
-async def cart_btn(message: types.Message):
-    cart = carts.get(message.from_user.id, {})
+async def cart_btn(message: types.Message, tenant: Tenant):
+    cart = tenant.carts.get(message.from_user.id, {})
     if not cart:
         return await message.answer("Savat bo‘sh ❗️")
 
-    text = cart_text(cart)
+    text = cart_text(tenant, cart)
     await message.answer(text, reply_markup=cart_only_clean_kb())
 
 # SAVAT - CALLBACK BUTTON
 @router.callback_query(F.data == "cart")
-async def open_cart(callback: types.CallbackQuery):
-    await cart_cmd(callback.message)
+async def open_cart(callback: types.CallbackQuery, tenant: Tenant):
+    await cart_cmd(callback.message, tenant)
     await callback.answer()
 # Cart Total
-def cart_total(cart):
+def cart_total(t: Tenant, cart):
     total = 0
     for pid, count in cart.items():
-        item = MENU_BY_ID[pid]
+        item = t.menu_by_id[pid]
         total += item["price"] * count
     return total
 
 # --- CART TEXT ---
-def cart_text(cart):
+def cart_text(t: Tenant, cart):
     if not cart:
         return "Savat bo‘sh 🛒"
 
     text = "🛒 Savatingiz:\n\n"
     for pid, count in cart.items():
-        item = MENU_BY_ID[pid]
+        item = t.menu_by_id[pid]
         text += f"• {item['name']} — {count} dona\n"
     return text
 
 
 # --- CART COMMAND ---
 @router.message(Command("cart"))
-async def cart_cmd(message: types.Message):
+async def cart_cmd(message: types.Message, tenant: Tenant):
     uid = message.from_user.id
-    cart = carts.get(uid, {})
+    cart = tenant.carts.get(uid, {})
 
-    await send_cart(message, cart)
+    await send_cart(tenant, message, cart)
 
 
 # --- SEND CART (universal refresh function) ---
-async def send_cart(msg_or_cb, cart):
+async def send_cart(t: Tenant, msg_or_cb, cart):
     kb_list = []
 
     for pid, count in cart.items():
-        item = MENU_BY_ID[pid]
+        item = t.menu_by_id[pid]
 
         kb_list.append([
             InlineKeyboardButton(text="➖", callback_data=f"dec|{pid}"),
@@ -363,7 +962,7 @@ async def send_cart(msg_or_cb, cart):
 
     kb = InlineKeyboardMarkup(inline_keyboard=kb_list)
 
-    text = cart_text(cart)
+    text = cart_text(t, cart)
 
     if isinstance(msg_or_cb, types.CallbackQuery):
         await msg_or_cb.message.edit_text(text, reply_markup=kb)
@@ -372,35 +971,37 @@ async def send_cart(msg_or_cb, cart):
 
 
 # --- INCREASE (+) ---
-@router.callback_query(F.data.startswith("inc|"))
-async def increase_item(callback: types.CallbackQuery):
+@router.callback_query(F.data.startswith("inc|"), flags={"throttling_key": "cart"})
+async def increase_item(callback: types.CallbackQuery, tenant: Tenant):
     uid = callback.from_user.id
     _, pid = callback.data.split("|")
     pid = int(pid)
 
-    carts.setdefault(uid, {})
-    carts[uid][pid] = carts[uid].get(pid, 0) + 1
+    tenant.carts.setdefault(uid, {})
+    if tenant.carts[uid].get(pid, 0) >= stock_left(tenant, pid):
+        return await callback.answer("Bugun boshqa qolmadi ❌")
+    tenant.carts[uid][pid] = tenant.carts[uid].get(pid, 0) + 1
 
     await callback.answer("Qo‘shildi ➕")
-    await send_cart(callback, carts[uid])
+    await send_cart(tenant, callback, tenant.carts[uid])
 
 
 # --- DECREASE (-) ---
-@router.callback_query(F.data.startswith("dec|"))
-async def decrease_item(callback: types.CallbackQuery):
+@router.callback_query(F.data.startswith("dec|"), flags={"throttling_key": "cart"})
+async def decrease_item(callback: types.CallbackQuery, tenant: Tenant):
     uid = callback.from_user.id
     _, pid = callback.data.split("|")
     pid = int(pid)
 
-    if pid in carts.get(uid, {}):
-        carts[uid][pid] -= 1
-        if carts[uid][pid] <= 0:
-            del carts[uid][pid]
+    if pid in tenant.carts.get(uid, {}):
+        tenant.carts[uid][pid] -= 1
+        if tenant.carts[uid][pid] <= 0:
+            del tenant.carts[uid][pid]
 
     await callback.answer("Kamaytirildi ➖")
-    await send_cart(callback, carts[uid])
-async def refresh_menu_item(callback: types.CallbackQuery, pid: int):
-    item = MENU_BY_ID[pid]
+    await send_cart(tenant, callback, tenant.carts[uid])
+async def refresh_menu_item(t: Tenant, callback: types.CallbackQuery, pid: int):
+    item = t.menu_by_id[pid]
 
     # формируем описание заново
     caption = (
@@ -426,19 +1027,20 @@ async def refresh_menu_item(callback: types.CallbackQuery, pid: int):
             parse_mode="Markdown"
         )
     except Exception as e:
-        print("refresh_menu_item error:", e)
+        logger.warning(f"refresh_menu_item error: {e}")
 
 # --- INSERT THIS FUNCTION RIGHT HERE ---
-async def refresh_menu_item(callback: types.CallbackQuery, pid: int):
+async def refresh_menu_item(t: Tenant, callback: types.CallbackQuery, pid: int):
     uid = callback.from_user.id
-    item = MENU_BY_ID[pid]
-    count = carts.get(uid, {}).get(pid, 0)
+    item = t.menu_by_id[pid]
+    count = t.carts.get(uid, {}).get(pid, 0)
 
     caption = (
         f"*{item['name']}*\n"
         f"{item['description']}\n\n"
         f"Narx: {format_price(item['price'])}\n"
-        f"Savatda: {count} dona"
+        f"Savatda: {count} dona\n"
+        f"{stock_label(t, pid)}"
     )
 
     kb = InlineKeyboardMarkup(
@@ -463,33 +1065,36 @@ async def refresh_menu_item(callback: types.CallbackQuery, pid: int):
 
 
 # --- MENU + ---
-@router.callback_query(F.data.startswith("incmenu|"))
-async def inc_menu_item(callback: types.CallbackQuery):
+@router.callback_query(F.data.startswith("incmenu|"), flags={"throttling_key": "cart"})
+async def inc_menu_item(callback: types.CallbackQuery, tenant: Tenant):
     uid = callback.from_user.id
     _, pid = callback.data.split("|")
     pid = int(pid)
 
-    carts.setdefault(uid, {})
-    carts[uid][pid] = carts[uid].get(pid, 0) + 1
+    tenant.carts.setdefault(uid, {})
+    if tenant.carts[uid].get(pid, 0) >= stock_left(tenant, pid):
+        await refresh_menu_item(tenant, callback, pid)
+        return await callback.answer("Bugun boshqa qolmadi ❌")
+    tenant.carts[uid][pid] = tenant.carts[uid].get(pid, 0) + 1
 
-    await refresh_menu_item(callback, pid)
+    await refresh_menu_item(tenant, callback, pid)
     await callback.answer("Qo‘shildi ➕")
 
 
 
 # --- MENU - ---
-@router.callback_query(F.data.startswith("decmenu|"))
-async def dec_menu_item(callback: types.CallbackQuery):
+@router.callback_query(F.data.startswith("decmenu|"), flags={"throttling_key": "cart"})
+async def dec_menu_item(callback: types.CallbackQuery, tenant: Tenant):
     uid = callback.from_user.id
     _, pid = callback.data.split("|")
     pid = int(pid)
 
-    if pid in carts.setdefault(uid, {}):
-        carts[uid][pid] -= 1
-        if carts[uid][pid] <= 0:
-            del carts[uid][pid]
+    if pid in tenant.carts.setdefault(uid, {}):
+        tenant.carts[uid][pid] -= 1
+        if tenant.carts[uid][pid] <= 0:
+            del tenant.carts[uid][pid]
 
-    await refresh_menu_item(callback, pid)
+    await refresh_menu_item(tenant, callback, pid)
     await callback.answer("Kamaytirildi ➖")
 
 
@@ -498,21 +1103,21 @@ async def dec_menu_item(callback: types.CallbackQuery):
 
 # --- CLEAR CART ---
 @router.callback_query(F.data == "clear_cart")
-async def clear_cart(callback: types.CallbackQuery):
-    carts[callback.from_user.id] = {}
+async def clear_cart(callback: types.CallbackQuery, tenant: Tenant):
+    tenant.carts[callback.from_user.id] = {}
     await callback.answer("Savat tozalandi 🗑️")
-    await send_cart(callback, {})
+    await send_cart(tenant, callback, {})
 
 # SHOW IMAGES
 @router.callback_query(F.data == "show_cart_images")
-async def show_images(callback: types.CallbackQuery, bot: Bot):
+async def show_images(callback: types.CallbackQuery, bot: Bot, tenant: Tenant):
     uid = callback.from_user.id
-    cart = carts.get(uid, {})
+    cart = tenant.carts.get(uid, {})
 
     media = []
     for pid, qty in cart.items():
-        item = MENU_BY_ID[pid]
-        path = IMAGES_DIR / item["image"]
+        item = tenant.menu_by_id[pid]
+        path = tenant.images_dir / item["image"]
         if path.exists():
             media.append(InputMediaPhoto(media=types.FSInputFile(path), caption=f"{item['name']} x{qty}"))
 
@@ -525,11 +1130,13 @@ async def show_images(callback: types.CallbackQuery, bot: Bot):
 
 
 # PAYMENT KEYBOARD
-def payment_kb():
+def payment_kb(order_id: int = None):
+    # Buyurtma raqami tugmada — chek restartdan keyin ham o'z buyurtmasiga bog'lanadi
+    callback_data = f"send_check|{order_id}" if order_id else "send_check"
     kb = InlineKeyboardMarkup(inline_keyboard=[
     
         [
-            InlineKeyboardButton(text="📤 Chekni yuborish", callback_data="send_check")
+            InlineKeyboardButton(text="📤 Chekni yuborish", callback_data=callback_data)
         ]
     ])
     return kb
@@ -537,17 +1144,17 @@ def payment_kb():
 
 # CHECKOUT (Reply button)
 @router.message(F.text == "📦 Buyurtma")
-async def checkout_btn(message: types.Message, state: FSMContext):
-    await checkout_start(message, state)
+async def checkout_btn(message: types.Message, state: FSMContext, tenant: Tenant):
+    await checkout_start(message, state, tenant)
 
 # CHECKOUT command
 @router.callback_query(F.data == "go_checkout")
 @router.message(Command("checkout"))
-async def checkout_start(target, state: FSMContext):
+async def checkout_start(target, state: FSMContext, tenant: Tenant):
     message = target.message if isinstance(target, types.CallbackQuery) else target
 
     uid = message.from_user.id
-    if not carts.get(uid):
+    if not tenant.carts.get(uid):
         await message.answer("Savat bo‘sh!")
         return
 
@@ -564,7 +1171,7 @@ async def phone_input(message: types.Message, state: FSMContext):
 
 # ADDRESS
 @router.message(CheckoutStates.awaiting_address)
-async def address_input(message: types.Message, state: FSMContext):
+async def address_input(message: types.Message, state: FSMContext, tenant: Tenant):
 
     # Agar foydalanuvchi lokatsiya yuborgan bo'lsa — shu manzil sifatida saqlanadi
     if message.location:
@@ -575,12 +1182,12 @@ async def address_input(message: types.Message, state: FSMContext):
         await state.update_data(address=message.text.strip())
 
     uid = message.from_user.id
-    cart = carts.get(uid, {})
+    cart = tenant.carts.get(uid, {})
     data = await state.get_data()
 
     text = (
         f"📦 *Buyurtma tafsilotlari:*\n\n"
-        f"{cart_text(cart)}\n\n"
+        f"{cart_text(tenant, cart)}\n\n"
         f"📞 {data['phone']}\n"
         f"📍 {data['address']}\n\n"
         f"Tasdiqlaysizmi?"
@@ -600,19 +1207,32 @@ async def address_input(message: types.Message, state: FSMContext):
 
 
 # CANCEL ORDER
-@router.callback_query(F.data == "confirm_order")
-async def confirm_order(callback: types.CallbackQuery, state: FSMContext):
-    print("🚀 Tasdiqlayman tugmasi bosildi!")  # TEST
+@router.callback_query(F.data == "confirm_order", CheckoutStates.confirm)
+async def confirm_order(callback: types.CallbackQuery, state: FSMContext, tenant: Tenant):
+    uid = callback.from_user.id
+    # Savatni birinchi await dan oldin olamiz — ikki marta bosish ikkinchi buyurtma bermaydi
+    cart = tenant.carts.pop(uid, None)
+    if not cart:
+        return await callback.answer("Savat bo‘sh!")
 
-    global order_counter   # <<< BUYURTMA RAQAMINI ISHLATISH
-    current_order_id = order_counter
-    order_counter += 1
+    current_order_id = tenant.order_counter   # <<< BUYURTMA RAQAMINI ISHLATISH
 
-    data = await state.get_data()
-    uid = callback.from_user.id
+    if not reserve_stock(tenant, current_order_id, uid, cart):
+        tenant.carts[uid] = cart
+        sold_out = [tenant.menu_by_id[pid]["name"] for pid, qty in cart.items() if qty > stock_left(tenant, pid)]
+        await callback.answer(
+            "Kechirasiz, bugun yetarli qolmadi: " + ", ".join(sold_out),
+            show_alert=True
+        )
+        return
+    tenant.order_counter += 1
+    logger.info(
+        "order confirmed",
+        extra={"fields": {"order_id": current_order_id, "user_id": uid, "items": len(cart)}}
+    )
 
-    cart = carts.get(uid, {})
-    total = cart_total(cart)
+    data = await state.get_data()
+    total = cart_total(tenant, cart)
 
     phone = data.get("phone", "Noma'lum")
     address = data.get("address", "Noma'lum")
@@ -620,7 +1240,7 @@ async def confirm_order(callback: types.CallbackQuery, state: FSMContext):
     text = (
         f"🆔 Buyurtma raqami: *#{current_order_id}*\n"
         "📦 *Yangi buyurtma!*\n\n"
-        f"{cart_text(cart)}\n\n"
+        f"{cart_text(tenant, cart)}\n\n"
         f"💰 *Jami:* {format_price(total)}\n"
         f"📞 {phone}\n"
         f"📍 {address}\n\n"
@@ -634,7 +1254,7 @@ async def confirm_order(callback: types.CallbackQuery, state: FSMContext):
         clean = address.replace("Lokatsiya:", "").strip()
         lat, lon = map(float, clean.split(","))
 
-    admin_id = ADMIN_CHAT_ID
+    admin_id = tenant.admin_chat_id
 
     # Adminlarga yuborish
     await callback.bot.send_message(admin_id, text)
@@ -649,12 +1269,28 @@ async def confirm_order(callback: types.CallbackQuery, state: FSMContext):
     "5614 6821 1714 8884\n\n"
     "To‘lov qilgandan so‘ng chekni yuboring.\n"
     "Quyidagi tugmani bosing:",
-    reply_markup=payment_kb()
+    reply_markup=payment_kb(current_order_id)
 )
 
 
     await state.clear()
-    carts[uid] = {}
+
+
+# --- ADMIN: BUYURTMANI BEKOR QILISH ---
+@router.message(Command("cancel_order"))
+async def admin_cancel_order(message: types.Message, tenant: Tenant):
+    if message.from_user.id != tenant.admin_chat_id:
+        return
+
+    parts = message.text.split()
+    if len(parts) != 2 or not parts[1].lstrip("#").isdigit():
+        return await message.answer("Foydalanish: /cancel_order <raqam>")
+
+    order_id = int(parts[1].lstrip("#"))
+    if release_stock(tenant, order_id):
+        await message.answer(f"Buyurtma #{order_id} bekor qilindi, nonlar qaytarildi ✅")
+    else:
+        await message.answer(f"Buyurtma #{order_id} topilmadi ❗️")
 
 
 # --- PAYMENT NOW ---
@@ -669,19 +1305,28 @@ async def pay_now(callback: types.CallbackQuery):
     await callback.answer()
 
 # --- SEND CHECK (ask image) ---
-@router.callback_query(F.data == "send_check")
-async def ask_check(callback: types.CallbackQuery, state: FSMContext):
+@router.callback_query(F.data.startswith("send_check"))
+async def ask_check(callback: types.CallbackQuery, state: FSMContext, tenant: Tenant):
+    _, _, order_id = callback.data.partition("|")
+    order_id = int(order_id) if order_id.isdigit() else user_reservation(tenant, callback.from_user.id)
+
     await callback.message.edit_text("📤 To‘lov chekini yuboring (rasm ko‘rinishida).")
     await state.set_state("waiting_for_check")
+    await state.update_data(order_id=order_id)
     await callback.answer()
 
 # --- RECEIVE CHECK (PHOTO or DOCUMENT) ---
 from aiogram.types import ReplyKeyboardRemove
 
 @router.message(StateFilter("waiting_for_check"), F.photo | F.document)
-async def process_check(message: types.Message, state: FSMContext):
+async def process_check(message: types.Message, state: FSMContext, tenant: Tenant):
 
-    admin_id = ADMIN_CHAT_ID
+    admin_id = tenant.admin_chat_id
+
+    # Chek keldi — band qilish muddati endi tugamaydi
+    order_id = (await state.get_data()).get("order_id")
+    if order_id is not None:
+        settle_reservation(tenant, order_id)
 
     # ADMIN GA CHEKNI YUBORISH
     if message.photo:
@@ -689,14 +1334,14 @@ async def process_check(message: types.Message, state: FSMContext):
         await message.bot.send_photo(
             admin_id,
             file_id,
-            caption="📥 Yangi to‘lov cheki!"
+            caption=f"📥 Yangi to‘lov cheki! (#{order_id})"
         )
     else:
         file_id = message.document.file_id
         await message.bot.send_document(
             admin_id,
             file_id,
-            caption="📥 Yangi to‘lov cheki!"
+            caption=f"📥 Yangi to‘lov cheki! (#{order_id})"
         )
 
     # FOYDALANUVCHIGA JAVOB
@@ -725,7 +1370,7 @@ async def process_check(message: types.Message, state: FSMContext):
 
 
     # SAVE TO DB
-    async with aiosqlite.connect(DB_FILE) as db:
+    async with aiosqlite.connect(tenant.db_file) as db:
         cur = await db.execute(
             "INSERT INTO orders (user_id, user_name, phone, address, total, status) VALUES (?, ?, ?, ?, ?, ?)",
             (uid, callback.from_user.username, data["phone"], data["address"], total, "new")
@@ -734,7 +1379,7 @@ async def process_check(message: types.Message, state: FSMContext):
         order_id = cur.lastrowid
 
         for pid, qty in cart.items():
-            item = MENU_BY_ID[pid]
+            item = tenant.menu_by_id[pid]
             await db.execute(
                 "INSERT INTO order_items (order_id, product_id, name, price, qty) VALUES (?, ?, ?, ?, ?)",
                 (order_id, pid, item["name"], item["price"], qty)
@@ -742,7 +1387,7 @@ async def process_check(message: types.Message, state: FSMContext):
 
         await db.commit()
 
-    carts[uid] = {}
+    tenant.carts[uid] = {}
     await state.clear()
 
     await callback.answer("Buyurtma tasdiqlandi!")
@@ -750,10 +1395,10 @@ async def process_check(message: types.Message, state: FSMContext):
 
     # SEND TO ADMIN
     await callback.bot.send_message(
-        ADMIN_CHAT_ID,
+        tenant.admin_chat_id,
         f"📦 Yangi buyurtma #{order_id}\n"
         f"👤 @{user.username}\n"
-        f"{cart_text(cart)}\n\n"
+        f"{cart_text(tenant, cart)}\n\n"
         f"📞 {data['phone']}\n📍 {data['address']}"
     )
 
@@ -761,14 +1406,33 @@ async def process_check(message: types.Message, state: FSMContext):
 #                   BOT START
 # ------------------------------------------------------
 async def main():
-    await init_db()
-    bot = Bot(token=BOT_TOKEN)
+    # Barcha filial botlari bitta HTTP connection pool dan foydalanadi
+    session = AiohttpSession()
+    session.middleware(log_bot_api)
+
+    bots = []
+    for t in load_tenants():
+        await init_db(t.db_file)
+        await load_stock(t)
+        bot = Bot(token=t.token, session=session)
+        tenants[bot.id] = t
+        bots.append(bot)
+
     dp = Dispatcher()
+    dp.update.outer_middleware(TenantMiddleware())
+    dp.update.outer_middleware(TracingMiddleware())
     dp.include_router(router)
 
-    print("🤖 Bot ishga tushdi!")
-    await dp.start_polling(bot)
+    workers = [asyncio.create_task(stock_flusher(t)) for t in tenants.values()]
+    workers += [asyncio.create_task(db_maintainer(t)) for t in tenants.values()]
+    logger.info(f"🤖 Bot ishga tushdi! Filiallar: {', '.join(t.name for t in tenants.values())}")
+    try:
+        await dp.start_polling(*bots)
+    finally:
+        for worker in workers:
+            worker.cancel()
+        for t in tenants.values():
+            await flush_stock(t)
 
 if __name__ == "__main__":
-    import asyncio
     asyncio.run(main())